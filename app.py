@@ -7,26 +7,45 @@
 # - Hybrid Ranking: semantic + BM25 + personalization
 # - Suggestion rewrites
 
+import io
 import os
 import re
-import json
+import sys
+import csv
+import time
+import queue
+import atexit
+import hashlib
 import sqlite3
 import logging
+import threading
+import importlib.util
+from contextlib import nullcontext, contextmanager
 from typing import Dict, List, Tuple, Optional
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter, deque
+from dataclasses import dataclass
 from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
 from datetime import datetime, timedelta
 import pickle
+import shutil
+import tempfile
 
 from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from pyngrok import ngrok
+from flask_compress import Compress
+import orjson
+from cachetools import TTLCache, LRUCache, LFUCache
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from rank_bm25 import BM25Okapi
+from scipy import sparse
+try:
+    from numba import njit, prange
+except ImportError:  # optional: score_candidates falls back to NumPy
+    njit, prange = None, range
 import spacy
-import nltk
 from nltk.corpus import wordnet as wn
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
@@ -35,43 +54,124 @@ logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 # App & Globals
 # ---------------------------
 MODEL_NAME = os.environ.get("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# "onnx" runs an INT8-quantized export through ONNX Runtime; "torch" uses SentenceTransformer
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "onnx").lower()
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "onnx_models")
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", str(os.cpu_count() or 4)))
+if EMBEDDING_BACKEND == "onnx" and importlib.util.find_spec("optimum") is None:
+    logging.warning("optimum[onnxruntime] is not installed; falling back to the torch embedding backend")
+    EMBEDDING_BACKEND = "torch"
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (jsonify, request.get_json)"""
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = self.option | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
-
-_model: Optional[SentenceTransformer] = None
-nlp = spacy.load("en_core_web_sm")
+# gzip/brotli for JSON and CSV bodies; streamed NDJSON (/data?stream=1) is left uncompressed
+app.config.update(
+    COMPRESS_MIMETYPES=["application/json", "text/csv"],
+    COMPRESS_ALGORITHM=["br", "gzip"],
+    COMPRESS_LEVEL=4,
+    COMPRESS_BR_LEVEL=4,
+    COMPRESS_MIN_SIZE=500,
+    COMPRESS_STREAMS=False,
+)
+Compress(app)
+
+_model = None
+# Only NER is used (detect_locations), so skip the tagger/parser pipes
+nlp = spacy.load("en_core_web_sm", disable=["tagger", "parser", "lemmatizer", "attribute_ruler"])
+
+# Content-addressed embedding caches: {blake2b(model + text): normalized vector}
+# EMB_CACHE holds candidate texts and is persisted across restarts; query vectors
+# live in their own smaller LRU and are never written to disk. Both are bounded.
+EMB_CACHE_PATH = os.environ.get("EMB_CACHE_PATH", "embedding_cache.pkl")
+EMB_CACHE_MAX_ENTRIES = int(os.environ.get("EMB_CACHE_MAX_ENTRIES", "200000"))
+QUERY_EMB_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_EMB_CACHE_MAX_ENTRIES", "10000"))
+EMB_CACHE: LRUCache = LRUCache(maxsize=EMB_CACHE_MAX_ENTRIES)
+QUERY_EMB_CACHE: LRUCache = LRUCache(maxsize=QUERY_EMB_CACHE_MAX_ENTRIES)
+_emb_cache_lock = threading.Lock()
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
 
 # Database setup
 DB_PATH = os.environ.get("DB_PATH", "ai_suggestions.db")
 API_KEYS = set([k.strip() for k in os.environ.get("API_KEYS", "demo-key").split(",") if k.strip()])
 
-# Simple in-memory rate limiter: {key: {window_start, count}}
+# In-memory token bucket per API key: {key: [tokens, last_refill_monotonic, lock]}
+# Seeded once for every configured key, so the dict never grows at runtime.
 RATE_LIMIT_PER_MINUTE = int(os.environ.get("RATE_LIMIT_PER_MINUTE", "120"))
-_rate_limit_state: Dict[str, Dict[str, float]] = defaultdict(dict)
+_RATE_LIMIT_PER_SECOND = RATE_LIMIT_PER_MINUTE / 60.0
+_buckets: Dict[str, list] = {
+    k: [float(RATE_LIMIT_PER_MINUTE), time.monotonic(), threading.Lock()] for k in API_KEYS
+}
 
 def require_api_key():
     key = request.headers.get("X-API-Key")
-    if not key or key not in API_KEYS:
+    bucket = _buckets.get(key) if key else None
+    if bucket is None:
         return False
-    # rate limiting per API key
-    now = datetime.utcnow()
-    window = now.replace(second=0, microsecond=0)
-    state = _rate_limit_state.get(key)
-    if not state or state.get("window") != window:
-        _rate_limit_state[key] = {"window": window, "count": 1}
-    else:
-        _rate_limit_state[key]["count"] += 1
-    if _rate_limit_state[key]["count"] > RATE_LIMIT_PER_MINUTE:
-        return "rate_limited"
+    # rate limiting per API key: refill continuously, spend one token per request
+    with bucket[2]:
+        now = time.monotonic()
+        tokens = min(float(RATE_LIMIT_PER_MINUTE), bucket[0] + (now - bucket[1]) * _RATE_LIMIT_PER_SECOND)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return "rate_limited"
+        bucket[0] = tokens - 1
     return True
 
+# Endpoints served without an API key (health checks)
+PUBLIC_ENDPOINTS = frozenset({"home", "health", "static"})
+
+@app.before_request
+def check_api_key():
+    """Authenticate and rate limit every API request before it reaches its handler"""
+    # CORS preflights and unknown routes (404/405) pass through untouched
+    if request.method == "OPTIONS" or request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    auth = require_api_key()
+    if auth is False:
+        return jsonify({"error": "Unauthorized"}), 401
+    if auth == "rate_limited":
+        return jsonify({"error": "Too Many Requests"}), 429
+    return None
+
 # Session cache for personalization
-USER_HISTORY_CACHE = defaultdict(list)
-# Cache for popular queries
-SUGGESTION_CACHE: Dict[str, Dict] = {}
+# All three caches are bounded so memory stays flat under long-running traffic.
+USER_HISTORY_PER_USER = 20
+USER_HISTORY_MAX_USERS = int(os.environ.get("USER_HISTORY_MAX_USERS", "100000"))
+USER_HISTORY_CACHE: LRUCache = LRUCache(maxsize=USER_HISTORY_MAX_USERS)  # {user_id: deque of recent queries}
+# Cache for popular queries, bounded by approximate bytes and expired by TTL
 SUGGESTION_CACHE_TTL_SECONDS = int(os.environ.get("SUGGESTION_CACHE_TTL_SECONDS", "300"))
-POPULAR_QUERIES: defaultdict = defaultdict(int)
+SUGGESTION_CACHE_MAX_BYTES = int(os.environ.get("SUGGESTION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+def _suggestion_entry_size(entry: Dict) -> int:
+    """Rough byte footprint of a SUGGESTION_CACHE value"""
+    size = 512 + sum(len(s) for s in entry["suggestions"]) * 2 + len(entry["cards"]) * 1024
+    if entry.get("debug"):
+        size += len(entry["debug"].get("top_candidates", [])) * 512
+    return size
+
+SUGGESTION_CACHE: TTLCache = TTLCache(maxsize=SUGGESTION_CACHE_MAX_BYTES, ttl=SUGGESTION_CACHE_TTL_SECONDS,
+                                      getsizeof=_suggestion_entry_size)
+POPULAR_QUERIES: LFUCache = LFUCache(maxsize=50_000)
+# Serialized /analytics responses: {(start, end, analytics version): {"json"|"csv": (body bytes, mimetype)}}
+ANALYTICS_CACHE_TTL_SECONDS = int(os.environ.get("ANALYTICS_CACHE_TTL_SECONDS", "30"))
+ANALYTICS_CACHE: TTLCache = TTLCache(maxsize=256, ttl=ANALYTICS_CACHE_TTL_SECONDS)
+# Bumped after feedback and event writes commit so dashboards see new activity before the TTL runs out
+_analytics_version = 0
+# cachetools caches reorder/expire on read, so every access goes through this lock
+_cache_lock = threading.Lock()
 
 # Learning data storage
 LEARNING_DATA = {
@@ -80,6 +180,9 @@ LEARNING_DATA = {
     "user_preferences": defaultdict(dict),
     "location_patterns": defaultdict(int)
 }
+# Bumped whenever query_patterns changes; /analytics re-serializes it only then
+_patterns_version = 0
+_patterns_snapshot: Tuple[int, bytes] = (-1, b"{}")
 
 # Weights (can be adjusted based on learning)
 WEIGHT_SEMANTIC = 0.7
@@ -91,92 +194,261 @@ BOOST_LEARNED_PATTERN = 0.15
 
 _word_re = re.compile(r"[a-zA-Z][a-zA-Z-']+")
 
+# Types accepted by POST /data (ordered for the error message) and by /batch_import
+MANUAL_DATA_TYPES = ("category", "member", "profession", "location", "synonym", "blacklist", "whitelist")
+BATCH_IMPORT_TYPES = frozenset({"category", "member", "profession", "location"})
+
+# Bumped on every manual data write so per-site indexes get rebuilt
+_manual_data_version = 0
+# Memoized manual data: {None (all rows), ("type", data_type) or ("derived", name): (manual data version, value)}
+# Keys are tuples so nothing taken from a request can collide with a derived value.
+_MANUAL_CACHE: Dict[Optional[Tuple[str, str]], Tuple[int, object]] = {}
+_manual_loaded_at = 0.0
+MANUAL_DATA_CACHE_TTL_SECONDS = int(os.environ.get("MANUAL_DATA_CACHE_TTL_SECONDS", "30"))
+
 # ---------------------------
 # Database & Learning Utils
 # ---------------------------
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=30000",
+)
+_db_local = threading.local()
+
+def get_db() -> sqlite3.Connection:
+    """Per-thread SQLite connection, opened and tuned once"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        # Room for every distinct statement the app issues, so each is prepared once per connection
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _db_local.conn = conn
+        _db_local.depth = 0
+    return conn
+
+@contextmanager
+def get_conn():
+    """
+    Yield the thread's connection inside a transaction: commit on success,
+    rollback on error. Nested uses join the outermost transaction.
+    """
+    conn = get_db()
+    depth = _db_local.depth
+    _db_local.depth = depth + 1
+    try:
+        if depth:
+            yield conn
+        else:
+            with conn:
+                yield conn
+    finally:
+        _db_local.depth = depth
+
 def init_database():
     """Initialize SQLite database for persistent storage"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Search history table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS search_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            query TEXT,
-            suggestions TEXT,
-            selected_suggestion TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            location TEXT,
-            success_rating INTEGER DEFAULT 0,
-            ab_variant TEXT
-        )
-    ''')
-    
-    # Manual data table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS manual_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            data_type TEXT, -- 'category', 'member', 'location', 'profession'
-            data_content TEXT, -- JSON content
-            added_by TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1
-        )
-    ''')
-    
-    # Learning patterns table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS learning_patterns (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            pattern_type TEXT, -- 'query', 'suggestion', 'location'
-            pattern_key TEXT,
-            pattern_value TEXT,
-            frequency INTEGER DEFAULT 1,
-            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Events table for conversions/clicks
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            event_type TEXT,
-            payload TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Attempt to add missing columns for migrations
+    with get_conn() as conn:
+        cursor = conn.cursor()
+
+        # Search history table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                query TEXT,
+                suggestions TEXT,
+                selected_suggestion TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                location TEXT,
+                success_rating INTEGER DEFAULT 0,
+                ab_variant TEXT
+            )
+        ''')
+
+        # Manual data table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS manual_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data_type TEXT, -- 'category', 'member', 'location', 'profession'
+                data_content TEXT, -- JSON content
+                added_by TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT 1
+            )
+        ''')
+
+        # Learning patterns table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS learning_patterns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pattern_type TEXT, -- 'query', 'suggestion', 'location'
+                pattern_key TEXT,
+                pattern_value TEXT,
+                frequency INTEGER DEFAULT 1,
+                last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Events table for conversions/clicks
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                event_type TEXT,
+                payload TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Attempt to add missing columns for migrations
+        try:
+            cursor.execute("ALTER TABLE search_history ADD COLUMN ab_variant TEXT")
+        except Exception:
+            pass
+
+        # Indexes for the per-request preference lookups and feedback UPDATE
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_sh_user_rating_ts
+            ON search_history(user_id, success_rating, timestamp DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_sh_user_query_ts
+            ON search_history(user_id, query, timestamp DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_md_type_active
+            ON manual_data(data_type, is_active)
+        ''')
+        # Indexes for the /analytics date range and GROUP BY scans
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sh_ts ON search_history(timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sh_query ON search_history(query)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_sh_sel
+            ON search_history(selected_suggestion) WHERE selected_suggestion IS NOT NULL
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ev_ts_type ON events(timestamp, event_type)')
+    analyze_database()
+    logging.info("Database initialized successfully")
+
+def analyze_database():
+    """Refresh query planner statistics (sampled, so cheap on large tables)"""
+    conn = get_db()
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+# ---------------------------
+# Background DB Writer
+# ---------------------------
+# Request handlers enqueue (sql, params); a single writer thread drains the queue
+# and commits everything that arrived within WRITE_BATCH_WINDOW_SECONDS together.
+# Consecutive statements with the same SQL go through one executemany call.
+WRITE_BATCH_WINDOW_SECONDS = float(os.environ.get("WRITE_BATCH_WINDOW_SECONDS", "0.05"))
+WRITE_BATCH_MAX = 500
+# Bounded so a stalled disk cannot grow memory without limit; when full, writers commit inline
+WRITE_QUEUE_MAX = int(os.environ.get("WRITE_QUEUE_MAX", "10000"))
+_WRITE_Q: "queue.Queue[Tuple[str, tuple]]" = queue.Queue(maxsize=WRITE_QUEUE_MAX)
+_writer_thread: Optional[threading.Thread] = None
+_writer_pid: Optional[int] = None
+_writer_lock = threading.Lock()
+
+def _flush_writes(batch: List[Tuple[str, tuple]]):
+    # Only invalidate cached /analytics once the rows are committed and visible to readers
+    touches_analytics = any(sql in _ANALYTICS_WRITE_SQL for sql, _ in batch)
     try:
-        cursor.execute("ALTER TABLE search_history ADD COLUMN ab_variant TEXT")
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, group in groupby(batch, key=itemgetter(0)):
+                conn.executemany(sql, [params for _, params in group])
+        if touches_analytics:
+            bump_analytics_version()
+        return
     except Exception:
-        pass
-    
-    conn.commit()
-    conn.close()
-    logging.info("Database initialized successfully")
+        logging.exception(f"Batched write of {len(batch)} statements failed; retrying one by one")
+    for sql, params in batch:
+        try:
+            with get_conn() as conn:
+                conn.execute(sql, params)
+        except Exception:
+            logging.exception("Dropping failed write")
+    if touches_analytics:
+        bump_analytics_version()
+
+def _writer_loop():
+    while True:
+        batch = [_WRITE_Q.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW_SECONDS
+        while len(batch) < WRITE_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_WRITE_Q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_writes(batch)
+
+def enqueue_write(sql: str, params: tuple):
+    """Queue a write for the background writer (started lazily, once per process)"""
+    global _writer_thread, _writer_pid
+    if _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer_pid != os.getpid():
+                _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+                _writer_thread.start()
+                _writer_pid = os.getpid()
+    try:
+        _WRITE_Q.put_nowait((sql, params))
+    except queue.Full:
+        logging.warning("Write queue full; writing synchronously")
+        _flush_writes([(sql, params)])
+
+def flush_pending_writes():
+    """Synchronously write whatever is still queued (used at shutdown)"""
+    batch = []
+    while True:
+        try:
+            batch.append(_WRITE_Q.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _flush_writes(batch)
+
+atexit.register(flush_pending_writes)
+
+_INSERT_SEARCH_SQL = '''
+    INSERT INTO search_history 
+    (user_id, query, suggestions, selected_suggestion, location, success_rating, ab_variant)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+_INSERT_EVENT_SQL = '''
+    INSERT INTO events (user_id, event_type, payload) VALUES (?, ?, ?)
+'''
+_FEEDBACK_SQL = '''
+    UPDATE search_history 
+    SET selected_suggestion = ?, success_rating = ?
+    WHERE user_id = ? AND query = ? AND timestamp > datetime('now', '-1 hour')
+    ORDER BY timestamp DESC LIMIT 1
+'''
+# Writes that change what /analytics reports beyond its TTL
+_ANALYTICS_WRITE_SQL = frozenset({_INSERT_EVENT_SQL, _FEEDBACK_SQL})
 
 def save_search_interaction(user_id: str, query: str, suggestions: List[str], 
                           selected: Optional[str] = None, location: Optional[str] = None,
-                          success_rating: int = 0):
-    """Save search interaction for learning"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO search_history 
-        (user_id, query, suggestions, selected_suggestion, location, success_rating)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, query, json.dumps(suggestions), selected, location, success_rating))
-    
-    conn.commit()
-    conn.close()
+                          success_rating: int = 0, ab_variant: Optional[str] = None):
+    """Save search interaction for learning (written asynchronously)"""
+    global _patterns_version
+    enqueue_write(_INSERT_SEARCH_SQL,
+                  (user_id, query, orjson.dumps(suggestions).decode("utf-8"), selected, location, success_rating, ab_variant))
     
     # Update learning patterns
     LEARNING_DATA["query_patterns"][query.lower()] += 1
+    _patterns_version += 1
     if selected:
         LEARNING_DATA["successful_suggestions"][selected.lower()] += 1
     if location:
@@ -184,98 +456,156 @@ def save_search_interaction(user_id: str, query: str, suggestions: List[str],
 
 def get_user_preferences(user_id: str) -> Dict:
     """Get learned user preferences"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT query, selected_suggestion, success_rating
-        FROM search_history 
-        WHERE user_id = ? AND success_rating > 3
-        ORDER BY timestamp DESC LIMIT 50
-    ''', (user_id,))
-    
     preferences = defaultdict(int)
-    for row in cursor.fetchall():
-        query, selected, rating = row
-        if selected:
-            preferences[selected.lower()] += rating
-    
-    conn.close()
+    with get_conn() as conn:
+        for selected, rating in conn.execute('''
+            SELECT selected_suggestion, success_rating
+            FROM search_history 
+            WHERE user_id = ? AND success_rating > 3
+            ORDER BY timestamp DESC LIMIT 50
+        ''', (user_id,)):
+            if selected:
+                preferences[selected.lower()] += rating
     return dict(preferences)
 
 def get_user_negative_preferences(user_id: str) -> Dict:
     """Collect negatively rated suggestions to suppress"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT selected_suggestion, success_rating FROM search_history
-        WHERE user_id = ? AND selected_suggestion IS NOT NULL AND success_rating <= 2
-        ORDER BY timestamp DESC LIMIT 100
-    ''', (user_id,))
     negatives = defaultdict(int)
-    for row in cursor.fetchall():
-        selected, rating = row
-        negatives[(selected or '').lower()] += (3 - int(rating or 0))
-    conn.close()
+    with get_conn() as conn:
+        for selected, rating in conn.execute('''
+            SELECT selected_suggestion, success_rating FROM search_history
+            WHERE user_id = ? AND selected_suggestion IS NOT NULL AND success_rating <= 2
+            ORDER BY timestamp DESC LIMIT 100
+        ''', (user_id,)):
+            negatives[(selected or '').lower()] += (3 - int(rating or 0))
     return dict(negatives)
 
+_INSERT_MANUAL_SQL = '''
+    INSERT INTO manual_data (data_type, data_content, added_by)
+    VALUES (?, ?, ?)
+'''
+
+def bump_manual_data_version() -> int:
+    """Invalidate memoized manual data and site indexes; call only after the write has committed"""
+    global _manual_data_version
+    with _cache_lock:
+        _manual_data_version += 1
+        return _manual_data_version
+
 def add_manual_data(data_type: str, data_content: Dict, added_by: str = "admin"):
     """Add manual data to the system"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO manual_data (data_type, data_content, added_by)
-        VALUES (?, ?, ?)
-    ''', (data_type, json.dumps(data_content), added_by))
-    
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        conn.execute(_INSERT_MANUAL_SQL, (data_type, orjson.dumps(data_content).decode("utf-8"), added_by))
+    bump_manual_data_version()
     logging.info(f"Added manual {data_type} data: {data_content}")
 
+def add_manual_data_many(data_type: str, contents: List[Dict], added_by: str = "admin"):
+    """
+    Add several manual data items of one type with a single executemany. Runs in a
+    savepoint, so a failure rolls back only this group of the caller's transaction;
+    the caller bumps the manual data version once that transaction commits.
+    """
+    rows = [(data_type, orjson.dumps(c).decode("utf-8"), added_by) for c in contents]
+    with get_conn() as conn:
+        conn.execute("SAVEPOINT manual_data_many")
+        try:
+            conn.executemany(_INSERT_MANUAL_SQL, rows)
+        except Exception:
+            conn.execute("ROLLBACK TO manual_data_many")
+            raise
+        finally:
+            conn.execute("RELEASE manual_data_many")
+    logging.info(f"Added {len(rows)} manual {data_type} items")
+
+def _load_manual_data() -> List[Dict]:
+    with get_conn() as conn:
+        return [
+            {"type": row["data_type"], "content": orjson.loads(row["data_content"])}
+            for row in conn.execute('''
+                SELECT data_type, data_content FROM manual_data 
+                WHERE is_active = 1
+            ''')
+        ]
+
+def _refresh_manual_data_if_stale():
+    """Reload manual data every MANUAL_DATA_CACHE_TTL_SECONDS to pick up rows written by other workers"""
+    global _manual_loaded_at
+    if time.monotonic() - _manual_loaded_at <= MANUAL_DATA_CACHE_TTL_SECONDS:
+        return
+    previous = _MANUAL_CACHE.get(None)
+    # Tag rows with the version seen before reading them, so a local write that
+    # commits mid-read can never have its new version cached with the old rows
+    version = _manual_data_version
+    rows = _load_manual_data()
+    _manual_loaded_at = time.monotonic()
+    if previous is not None and previous[1] != rows and _manual_data_version == version:
+        version = bump_manual_data_version()
+    _MANUAL_CACHE[None] = (version, rows)
+
+def _memoize_manual(key: Optional[Tuple[str, str]], build):
+    """Return build() memoized until _manual_data_version changes"""
+    _refresh_manual_data_if_stale()
+    version = _manual_data_version
+    cached = _MANUAL_CACHE.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    value = build()
+    _MANUAL_CACHE[key] = (version, value)
+    return value
+
 def get_manual_data(data_type: Optional[str] = None) -> List[Dict]:
-    """Retrieve manual data"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+    """Retrieve manual data (memoized; callers must not mutate the result)"""
+    if not data_type:
+        return _memoize_manual(None, _load_manual_data)
+    if data_type not in MANUAL_DATA_TYPES:
+        return []
+    # Filter inside the builder so the list is tagged with the version it was read under
+    return _memoize_manual(("type", data_type),
+                           lambda: [i["content"] for i in get_manual_data() if i["type"] == data_type])
+
+MANUAL_DATA_STREAM_BATCH = 1000
+
+def iter_manual_data(data_type: Optional[str] = None):
+    """Yield active (data_type, raw JSON content) rows from the database, one fetchmany batch at a time"""
+    sql = "SELECT data_type, data_content FROM manual_data WHERE is_active = 1"
+    params: tuple = ()
     if data_type:
-        cursor.execute('''
-            SELECT data_content FROM manual_data 
-            WHERE data_type = ? AND is_active = 1
-        ''', (data_type,))
-    else:
-        cursor.execute('''
-            SELECT data_type, data_content FROM manual_data 
-            WHERE is_active = 1
-        ''')
-    
-    results = []
-    for row in cursor.fetchall():
-        if data_type:
-            results.append(json.loads(row[0]))
-        else:
-            results.append({"type": row[0], "content": json.loads(row[1])})
-    
-    conn.close()
-    return results
+        sql += " AND data_type = ?"
+        params = (data_type,)
+    cursor = get_db().execute(sql, params)
+    cursor.arraysize = MANUAL_DATA_STREAM_BATCH
+    try:
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
 
 # ---------------------------
 # Quality Controls & Ontology
 # ---------------------------
 def get_synonyms_map() -> Dict[str, List[str]]:
-    maps = {}
-    for item in get_manual_data("synonym"):
-        base = (item.get("base") or "").lower()
-        terms = [t.lower() for t in item.get("terms", [])]
-        if base:
-            maps[base] = terms
-    return maps
+    def build():
+        maps = {}
+        for item in get_manual_data("synonym"):
+            base = (item.get("base") or "").lower()
+            terms = [t.lower() for t in item.get("terms", [])]
+            if base:
+                maps[base] = terms
+        return maps
+    return _memoize_manual(("derived", "synonyms_map"), build)
 
 def get_blacklist() -> List[str]:
-    return [(item.get("term") or "").lower() for item in get_manual_data("blacklist") if item.get("term")]
+    return _memoize_manual(("derived", "blacklist_terms"), lambda: [
+        (item.get("term") or "").lower() for item in get_manual_data("blacklist") if item.get("term")
+    ])
 
 def get_whitelist() -> List[str]:
-    return [(item.get("term") or "").lower() for item in get_manual_data("whitelist") if item.get("term")]
+    return _memoize_manual(("derived", "whitelist_terms"), lambda: [
+        (item.get("term") or "").lower() for item in get_manual_data("whitelist") if item.get("term")
+    ])
 
 # ---------------------------
 # Utils
@@ -283,53 +613,213 @@ def get_whitelist() -> List[str]:
 def tokenize(text: str) -> List[str]:
     return [w.lower() for w in _word_re.findall(text or "")]
 
+class OnnxEncoder:
+    """INT8-quantized ONNX Runtime stand-in for SentenceTransformer.encode"""
+    QUANTIZED_FILE = "model_quantized.onnx"
+    max_seq_length = 256
+
+    def __init__(self, model_name: str, cache_dir: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        model_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        if not os.path.exists(os.path.join(model_dir, self.QUANTIZED_FILE)):
+            # Export into a private directory and rename it into place, so workers starting
+            # together never load a half-written model; the first rename wins.
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix=f".{os.path.basename(model_dir)}.", dir=cache_dir)
+            try:
+                logging.info(f"Exporting {model_name} to ONNX and quantizing to INT8 in {model_dir}")
+                ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(tmp_dir)
+                quantizer = ORTQuantizer.from_pretrained(tmp_dir)
+                qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+                AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_dir)
+                try:
+                    os.replace(tmp_dir, model_dir)
+                except OSError:
+                    if not os.path.exists(os.path.join(model_dir, self.QUANTIZED_FILE)):
+                        raise
+                    logging.info(f"Another worker already exported {model_dir}; using it")
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=self.QUANTIZED_FILE)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.config.hidden_size
+
+    def encode(self, texts: List[str], batch_size: int = 64, **_) -> np.ndarray:
+        """Mean-pooled, L2-normalized embeddings (same output as normalize_embeddings=True)"""
+        out = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[i:i + batch_size], padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors="np")
+            hidden = np.asarray(self.model(**enc).last_hidden_state)
+            mask = enc["attention_mask"][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled = pooled.astype(np.float32)
+            out.append(normalize(pooled, out=pooled))
+        if not out:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.vstack(out)
+
 @lru_cache(maxsize=1)
-def get_model() -> SentenceTransformer:
+def get_model():
     global _model
     if _model is None:
-        logging.info(f"Loading embedding model: {MODEL_NAME}")
-        _model = SentenceTransformer(MODEL_NAME)
+        logging.info(f"Loading embedding model: {MODEL_NAME} ({EMBEDDING_BACKEND})")
+        if EMBEDDING_BACKEND == "onnx":
+            _model = OnnxEncoder(MODEL_NAME, ONNX_MODEL_DIR)
+        else:
+            from sentence_transformers import SentenceTransformer
+            _configure_torch()
+            _model = SentenceTransformer(MODEL_NAME)
     return _model
 
-def normalize(vecs: np.ndarray) -> np.ndarray:
-    norms = np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12
-    return vecs / norms
-
-def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
-    return normalize(a) @ normalize(b).T
+def _emb_key(text: str) -> str:
+    return hashlib.blake2b(f"{MODEL_NAME}:{EMBEDDING_BACKEND}\x00{text}".encode("utf-8"), digest_size=16).hexdigest()
 
-def expand_synonyms(word: str) -> List[str]:
+def _configure_torch():
+    """Use every core for GEMMs and turn off autograd for inference"""
+    import torch
+    torch.set_num_threads(TORCH_NUM_THREADS)
+    torch.set_grad_enabled(False)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # only settable before torch starts any inter-op work
+
+def _inference_context():
+    if EMBEDDING_BACKEND == "torch":
+        import torch
+        return torch.inference_mode()
+    return nullcontext()
+
+def _encode_length_sorted(texts: List[str]) -> np.ndarray:
+    """Encode in token-length order so each batch pads to a similar length"""
+    model = get_model()
+    lengths = [len(model.tokenizer.tokenize(t)) for t in texts]
+    order = np.argsort(lengths, kind="stable")
+    with _inference_context():
+        vecs = model.encode([texts[i] for i in order], batch_size=EMBEDDING_BATCH_SIZE, convert_to_numpy=True,
+                            normalize_embeddings=True, show_progress_bar=False)
+    return vecs[np.argsort(order)]
+
+def encode_texts(texts: List[str], cache: Optional[LRUCache] = None) -> np.ndarray:
+    """Encode texts, only running the model on texts missing from cache (EMB_CACHE by default)"""
+    if cache is None:
+        cache = EMB_CACHE
+    keys = [_emb_key(t) for t in texts]
+    found: Dict[str, np.ndarray] = {}
+    with _emb_cache_lock:
+        for key in keys:
+            vec = cache.get(key)
+            if vec is not None:
+                found[key] = vec
+    missing = {key: text for key, text in zip(keys, texts) if key not in found}
+    if missing:
+        encoded = dict(zip(missing.keys(), _encode_length_sorted(list(missing.values()))))
+        found.update(encoded)
+        with _emb_cache_lock:
+            cache.update(encoded)
+    if not keys:
+        return np.zeros((0, get_model().get_sentence_embedding_dimension()), dtype=np.float32)
+    return np.stack([found[k] for k in keys])
+
+def load_embedding_cache():
+    """Warm EMB_CACHE from the pickle written on the previous shutdown"""
+    if not os.path.exists(EMB_CACHE_PATH):
+        return
+    try:
+        with open(EMB_CACHE_PATH, "rb") as f:
+            cached = pickle.load(f)
+        with _emb_cache_lock:
+            EMB_CACHE.update(cached)
+        logging.info(f"Loaded {len(EMB_CACHE)} cached embeddings from {EMB_CACHE_PATH}")
+    except Exception:
+        logging.exception("Could not load embedding cache")
+
+def save_embedding_cache():
+    """Persist EMB_CACHE so the next cold start skips re-encoding the catalog"""
+    with _emb_cache_lock:
+        snapshot = dict(EMB_CACHE)
+    if not snapshot:
+        return
+    tmp_path = f"{EMB_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, EMB_CACHE_PATH)
+    except Exception:
+        logging.exception("Could not save embedding cache")
+
+load_embedding_cache()
+atexit.register(save_embedding_cache)
+
+def normalize(vecs: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """L2-normalize rows; pass out=vecs to normalize in place"""
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms += 1e-12
+    return np.divide(vecs, norms, out=out)
+
+def cosine_similarity_prenorm(a_norm: np.ndarray, b_norm: np.ndarray) -> np.ndarray:
+    """Cosine similarity for inputs that are already unit length"""
+    return a_norm @ b_norm.T
+
+# Candidate embeddings held by site indexes: "int8" (quantized, 1/4 the memory) or "float32"
+INDEX_EMBEDDING_DTYPE = os.environ.get("INDEX_EMBEDDING_DTYPE", "int8")
+SCORE_BLOCK_ROWS = 1024
+
+def quantize_int8(vecs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-dimension int8 quantization; returns (codes, scale) with vecs ~= codes * scale"""
+    scale = np.abs(vecs).max(axis=0) / 127.0 if len(vecs) else np.ones(vecs.shape[1])
+    scale[scale == 0] = 1.0
+    codes = np.rint(vecs / scale).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+def _int8_dot(q_scaled, codes):
+    out = np.empty(codes.shape[0], dtype=np.float32)
+    for i in range(codes.shape[0]):
+        acc = np.float32(0.0)
+        for j in range(codes.shape[1]):
+            acc += q_scaled[j] * np.float32(codes[i, j])
+        out[i] = acc
+    return out
+
+_int8_dot_jit = njit(cache=True, fastmath=True)(_int8_dot) if njit is not None else None
+
+def cosine_similarity_int8(q_norm: np.ndarray, codes: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """Cosine similarity of one unit query vector against int8-quantized unit rows"""
+    q_scaled = np.asarray(q_norm, dtype=np.float32).ravel() * scale
+    if _int8_dot_jit is not None:
+        return _int8_dot_jit(q_scaled, codes)
+    # NumPy has no int8 matmul: upcast one cache-sized block of rows at a time
+    out = np.empty(len(codes), dtype=np.float32)
+    buf = np.empty((min(SCORE_BLOCK_ROWS, len(codes)), codes.shape[1]), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_BLOCK_ROWS):
+        block = codes[start:start + SCORE_BLOCK_ROWS]
+        rows = buf[:len(block)]
+        rows[...] = block
+        np.matmul(rows, q_scaled, out=out[start:start + len(block)])
+    return out
+
+@lru_cache(maxsize=4096)
+def expand_synonyms(word: str) -> Tuple[str, ...]:
     synonyms = set()
     for syn in wn.synsets(word):
         for lemma in syn.lemmas():
             synonyms.add(lemma.name().replace("_", " "))
-    return list(synonyms)
+    return tuple(synonyms)
 
-def detect_locations(text: str) -> List[str]:
+@lru_cache(maxsize=4096)
+def detect_locations(text: str) -> Tuple[str, ...]:
     doc = nlp(text)
-    return [ent.text for ent in doc.ents if ent.label_ in ["GPE", "LOC"]]
+    return tuple(ent.text for ent in doc.ents if ent.label_ in ("GPE", "LOC"))
 
-def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Calculate distance between two coordinates in kilometers"""
-    from math import radians, cos, sin, asin, sqrt
-    
-    # Convert to radians
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6371  # Radius of earth in kilometers
-    return c * r
-
-def get_location_boost(user_lat: Optional[float], user_lon: Optional[float], 
-                      candidate_location: Optional[str]) -> float:
-    """Calculate location-based boost for candidates"""
-    if not user_lat or not user_lon or not candidate_location:
-        return 0.0
-    
+def location_keyword_boost(candidate_location: str) -> float:
+    """Text-only proximity hint ("near", "local", ...) for candidates without coordinates"""
     # This is a simplified version - in production you'd use a geocoding service
     # to convert location strings to coordinates
     boost = 0.0
@@ -342,15 +832,27 @@ def get_location_boost(user_lat: Optional[float], user_lon: Optional[float],
     
     return min(boost, 0.2)  # Cap the boost
 
+EARTH_RADIUS_KM = 6371
+
+def haversine_km(lat: float, lon: float, lats_rad: np.ndarray, lons_rad: np.ndarray,
+                 cos_lats: np.ndarray) -> np.ndarray:
+    """Distance in km from (lat, lon) to every point; NaN where the point is missing"""
+    lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+    a = np.sin((lats_rad - lat_rad) / 2) ** 2 + cos_lats * np.cos(lat_rad) * np.sin((lons_rad - lon_rad) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
 # ---------------------------
 # Candidate building
 # ---------------------------
-def build_candidates(site_data: Dict) -> List[Dict]:
+def build_candidates(site_data: Dict) -> Tuple[List[Dict], List[Dict]]:
     """
     Build candidates from categories, member metadata, and manual data.
-    Each candidate is {text, type, extra}
+    Each candidate is {text, type, member_idx}; member-derived candidates (name, tags,
+    review) share one attribute dict in members instead of each carrying a copy.
+    Returns (candidates, members).
     """
     candidates = []
+    members = []
 
     # Categories (Top → Sub → Subsub)
     for cat in site_data.get("categories", []):
@@ -384,9 +886,9 @@ def build_candidates(site_data: Dict) -> List[Dict]:
         promo_badge = mem.get("promo_badge")
         hours = mem.get("hours")
 
-        base_cand = {
-            "text": name or "",
-            "type": "member",
+        member_idx = len(members)
+        members.append({
+            "name": name,
             "rating": rating,
             "location": location,
             "profile_url": profile_url,
@@ -400,17 +902,13 @@ def build_candidates(site_data: Dict) -> List[Dict]:
             "last_updated": last_updated,
             "promo_badge": promo_badge,
             "hours": hours,
-        }
+        })
         if name:
-            candidates.append(dict(base_cand))
+            candidates.append({"text": name, "type": "member", "member_idx": member_idx})
         for t in [tt.strip() for tt in tags if tt.strip()]:
-            tag_cand = dict(base_cand)
-            tag_cand.update({"text": t, "type": "tag"})
-            candidates.append(tag_cand)
+            candidates.append({"text": t, "type": "tag", "member_idx": member_idx})
         if reviews:
-            rev_cand = dict(base_cand)
-            rev_cand.update({"text": reviews, "type": "review"})
-            candidates.append(rev_cand)
+            candidates.append({"text": reviews, "type": "review", "member_idx": member_idx})
 
     # Add manual data
     manual_data = get_manual_data()
@@ -425,7 +923,8 @@ def build_candidates(site_data: Dict) -> List[Dict]:
             location = content.get("location", "")
             rating = content.get("rating", 0)
             if name:
-                candidates.append({"text": name, "type": "manual_member", "rating": rating, "location": location})
+                candidates.append({"text": name, "type": "manual_member", "member_idx": len(members)})
+                members.append({"name": name, "rating": rating, "location": location})
         elif data_type == "profession":
             candidates.append({"text": content.get("name", ""), "type": "manual_profession"})
         elif data_type == "location":
@@ -437,13 +936,200 @@ def build_candidates(site_data: Dict) -> List[Dict]:
         if c["text"].lower() not in seen:
             uniq.append(c)
             seen.add(c["text"].lower())
-    return uniq
+    return uniq, members
+
+# ---------------------------
+# Site Index
+# ---------------------------
+SITE_INDEX_CACHE_SIZE = int(os.environ.get("SITE_INDEX_CACHE_SIZE", "32"))
+_SITE_INDEX_CACHE: "OrderedDict[str, SiteIndex]" = OrderedDict()
+_site_index_lock = threading.Lock()
+
+# BM25Okapi parameters (same defaults as rank_bm25)
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+def build_bm25_matrix(tokenized: List[List[str]]) -> Tuple[sparse.csc_matrix, Dict[str, int]]:
+    """
+    Precompute every (doc, term) BM25Okapi contribution into a sparse matrix.
+    Scoring a query is then a column gather + row sum instead of a Python loop.
+    """
+    vocab: Dict[str, int] = {}
+    rows, cols, tfs = [], [], []
+    for i, toks in enumerate(tokenized):
+        for term, tf in Counter(toks).items():
+            rows.append(i)
+            cols.append(vocab.setdefault(term, len(vocab)))
+            tfs.append(tf)
+    rows = np.asarray(rows, dtype=np.int32)
+    cols = np.asarray(cols, dtype=np.int32)
+    tfs = np.asarray(tfs, dtype=np.float64)
+
+    n_docs = len(tokenized)
+    doc_len = np.array([len(t) for t in tokenized], dtype=np.float64)
+    avgdl = (doc_len.sum() / n_docs) if n_docs else 0.0
+    df = np.bincount(cols, minlength=len(vocab))
+    idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+    if len(idf):
+        # Like BM25Okapi, floor negative IDFs (very common terms) at epsilon * mean IDF
+        idf[idf < 0] = BM25_EPSILON * idf.mean()
+
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / (avgdl or 1.0))
+    weights = idf[cols] * tfs * (BM25_K1 + 1) / (tfs + length_norm[rows])
+    matrix = sparse.csc_matrix((weights, (rows, cols)), shape=(n_docs, len(vocab)))
+    return matrix, vocab
+
+PREMIUM_PLANS = ("premium", "gold", "platinum")
+
+def _to_float(value, default: float = np.nan) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+@dataclass
+class SiteIndex:
+    """Per-site ranking artifacts, built once per site_data/manual data revision"""
+    candidates: List[Dict]
+    members: List[Dict]  # attribute dicts referenced by candidate["member_idx"]
+    bm25_matrix: sparse.csc_matrix  # (n_candidates, vocab) BM25 term contributions
+    vocab: Dict[str, int]
+    c_vecs: np.ndarray  # L2-normalized, one row per candidate; int8 codes when c_scale is set
+    c_scale: Optional[np.ndarray]  # per-dimension int8 scale (see quantize_int8)
+
+    # Struct-of-arrays view of candidate attributes, one entry per candidate
+    texts_lower: List[str]
+    positions: Dict[str, int]  # lowercased text -> row (texts are unique after dedup)
+    locations_lower: List[str]
+    static_boost: np.ndarray  # rating + business rule + promo boosts
+    location_text_boost: np.ndarray  # location_keyword_boost() fallback for rows without coordinates
+    has_coords: np.ndarray  # latitude/longitude supplied (even if unparseable)
+    lats_rad: np.ndarray  # NaN where missing or unparseable
+    lons_rad: np.ndarray
+    cos_lats: np.ndarray
+    # {weekday: (rows, start_minutes, end_minutes)} one entry per opening interval
+    open_intervals: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+    def member(self, cand: Dict) -> Dict:
+        """Attributes (rating, location, profile_url, ...) behind a candidate; empty for categories"""
+        idx = cand.get("member_idx")
+        return self.members[idx] if idx is not None else {}
+
+    def semantic_scores(self, q_vec: np.ndarray) -> np.ndarray:
+        if self.c_scale is None:
+            return cosine_similarity_prenorm(q_vec, self.c_vecs).ravel()
+        return cosine_similarity_int8(q_vec, self.c_vecs, self.c_scale)
+
+    def bm25_scores(self, tokens: List[str]) -> np.ndarray:
+        cols = [self.vocab[t] for t in tokens if t in self.vocab]
+        if not cols:
+            return np.zeros(len(self.candidates))
+        return np.asarray(self.bm25_matrix[:, cols].sum(axis=1)).ravel()
+
+def site_fingerprint(site_data: Dict) -> str:
+    # Refresh first so a cached index never outlives manual data written by another worker
+    _refresh_manual_data_if_stale()
+    blob = orjson.dumps(site_data, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return f"{hashlib.blake2b(blob, digest_size=16).hexdigest()}:{_manual_data_version}"
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+def _hhmm_to_minutes(value: str) -> int:
+    hours, minutes = str(value).split(":")
+    return int(hours) * 60 + int(minutes)
+
+def _build_open_intervals(attrs: List[Dict]) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Flatten {"mon": [["09:00","17:00"]], ...} hours into per-weekday minute arrays"""
+    flat = {day: ([], [], []) for day in WEEKDAYS}
+    for i, attr in enumerate(attrs):
+        hours = attr.get("hours")
+        if not hours or not isinstance(hours, dict):
+            continue
+        for day in WEEKDAYS:
+            for interval in hours.get(day) or []:
+                try:
+                    start, end = interval
+                    start_min, end_min = _hhmm_to_minutes(start), _hhmm_to_minutes(end)
+                except (TypeError, ValueError):
+                    continue
+                flat[day][0].append(i)
+                flat[day][1].append(start_min)
+                flat[day][2].append(end_min)
+    return {
+        day: (np.array(rows, dtype=np.int64), np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32))
+        for day, (rows, starts, ends) in flat.items()
+    }
+
+def build_site_index(candidates: List[Dict], members: List[Dict]) -> SiteIndex:
+    texts = [c["text"] for c in candidates]
+    texts_lower = [t.lower() for t in texts]
+    attrs = [members[c["member_idx"]] if c.get("member_idx") is not None else {} for c in candidates]
+    locations_lower = [(a.get("location") or "").lower() for a in attrs]
+
+    ratings = np.array([_to_float(a.get("rating", 0), 0.0) for a in attrs], dtype=np.float32)
+    featured = np.array([bool(a.get("featured")) for a in attrs])
+    premium = np.array([a.get("plan_level") in PREMIUM_PLANS for a in attrs])
+    priority = np.array([_to_float(a.get("priority_score", 0), 0.0) for a in attrs], dtype=np.float32)
+    promo = np.array([bool(a.get("promo_badge")) for a in attrs])
+    static_boost = ((ratings >= 4.5) * BOOST_HIGH_RATING + featured * 0.1 + premium * 0.08
+                    + priority * 0.05 + promo * 0.03)
+
+    has_coords = np.array([a.get("latitude") is not None and a.get("longitude") is not None for a in attrs])
+    lats_rad = np.radians(np.array([_to_float(a.get("latitude")) for a in attrs], dtype=np.float64))
+    lons_rad = np.radians(np.array([_to_float(a.get("longitude")) for a in attrs], dtype=np.float64))
+    # A row is only usable for distance if both coordinates parsed
+    lons_rad[np.isnan(lats_rad)] = np.nan
+    lats_rad[np.isnan(lons_rad)] = np.nan
+    location_text_boost = np.array([location_keyword_boost(loc) for loc in locations_lower])
+
+    bm25_matrix, vocab = build_bm25_matrix([tokenize(t) for t in texts])
+    c_vecs, c_scale = encode_texts(texts), None
+    if INDEX_EMBEDDING_DTYPE == "int8":
+        c_vecs, c_scale = quantize_int8(c_vecs)
+    return SiteIndex(
+        candidates=candidates,
+        members=members,
+        bm25_matrix=bm25_matrix,
+        vocab=vocab,
+        c_vecs=c_vecs,
+        c_scale=c_scale,
+        texts_lower=texts_lower,
+        positions={t: i for i, t in enumerate(texts_lower)},
+        locations_lower=locations_lower,
+        static_boost=static_boost.astype(np.float64),
+        location_text_boost=location_text_boost,
+        has_coords=has_coords,
+        lats_rad=lats_rad,
+        lons_rad=lons_rad,
+        cos_lats=np.cos(lats_rad),
+        open_intervals=_build_open_intervals(attrs),
+    )
+
+def get_site_index(site_data: Dict) -> Optional[SiteIndex]:
+    """Return the cached SiteIndex for site_data, building it on first use"""
+    key = site_fingerprint(site_data)
+    with _site_index_lock:
+        index = _SITE_INDEX_CACHE.get(key)
+        if index is not None:
+            _SITE_INDEX_CACHE.move_to_end(key)
+            return index
+
+    candidates, members = build_candidates(site_data)
+    if not candidates:
+        return None
+    index = build_site_index(candidates, members)
+    with _site_index_lock:
+        _SITE_INDEX_CACHE[key] = index
+        while len(_SITE_INDEX_CACHE) > SITE_INDEX_CACHE_SIZE:
+            _SITE_INDEX_CACHE.popitem(last=False)
+    return index
 
 # ---------------------------
 # Hybrid Ranking
 # ---------------------------
-def hybrid_rank(query: str, candidates: List[Dict]) -> List[Tuple[Dict, float]]:
-    model = get_model()
+def hybrid_rank(query: str, index: SiteIndex) -> np.ndarray:
+    """Semantic + BM25 score for every candidate in index, in index order"""
     # Expand query with manual synonyms
     synonyms_map = get_synonyms_map()
     expanded_query_parts = [query]
@@ -452,17 +1138,11 @@ def hybrid_rank(query: str, candidates: List[Dict]) -> List[Tuple[Dict, float]]:
             expanded_query_parts.extend(terms)
     expanded_query = " ".join(expanded_query_parts)
 
-    texts = [c["text"] for c in candidates]
-    embeddings = model.encode([expanded_query] + texts, convert_to_numpy=True)
-    q_vec, c_vecs = embeddings[0:1], embeddings[1:]
-    semantic_scores = cosine_similarity(q_vec, c_vecs).ravel()
-
-    tokenized_cands = [tokenize(c["text"]) for c in candidates]
-    bm25 = BM25Okapi(tokenized_cands)
-    bm25_scores = bm25.get_scores(tokenize(expanded_query))
+    q_vec = encode_texts([expanded_query], cache=QUERY_EMB_CACHE)
+    semantic_scores = index.semantic_scores(q_vec)
+    bm25_scores = index.bm25_scores(tokenize(expanded_query))
 
-    combined = WEIGHT_SEMANTIC * semantic_scores + WEIGHT_BM25 * bm25_scores
-    return list(zip(candidates, combined))
+    return WEIGHT_SEMANTIC * semantic_scores + WEIGHT_BM25 * bm25_scores
 
 # ---------------------------
 # Suggestion Rewriting
@@ -521,38 +1201,98 @@ def rewrite_with_intent(base: str, city: Optional[str], intent: str) -> List[str
 # ---------------------------
 # Main Ranking Pipeline
 # ---------------------------
-def _is_open_now(hours: Optional[Dict]) -> bool:
-    if not hours or not isinstance(hours, dict):
-        return False
-    # Expect format: {"mon": [["09:00","17:00"]], ...}
-    now = datetime.now()
-    weekday = ["mon","tue","wed","thu","fri","sat","sun"][now.weekday()]
-    intervals = hours.get(weekday, [])
-    current = now.strftime("%H:%M")
-    for start, end in intervals:
-        if start <= current <= end:
-            return True
-    return False
+# Candidates kept after ranking: top 5 feed suggestions/cards, all feed debug output
+TOP_K = 10
+
+def _rank_kernel(base, boosts, keep, lats_rad, lons_rad, cos_lats, has_coords, location_text_boost,
+                 use_geo, ulat, ulon, radius_km):
+    """
+    Fused per-candidate loop: distance, distance decay, radius filter, text location
+    fallback and final score. Filtered rows score -inf; distances are NaN when unknown.
+    Compiled with Numba when available. radius_km is NaN when no radius is set.
+    """
+    n = base.shape[0]
+    combined = np.empty(n)
+    distances = np.full(n, np.nan)
+    ulat_rad = ulat * np.pi / 180.0
+    ulon_rad = ulon * np.pi / 180.0
+    cos_ulat = np.cos(ulat_rad)
+    for i in prange(n):
+        score = base[i] + boosts[i]
+        ok = keep[i]
+        if use_geo:
+            if has_coords[i]:
+                a = (np.sin((lats_rad[i] - ulat_rad) / 2) ** 2
+                     + cos_lats[i] * cos_ulat * np.sin((lons_rad[i] - ulon_rad) / 2) ** 2)
+                d = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(min(a, 1.0)))
+                if not np.isnan(d):
+                    distances[i] = d
+                    # distance decay: within 5km strong, 5-20 moderate
+                    if d <= 5:
+                        score += 0.15
+                    elif d <= 20:
+                        score += 0.08
+                    if d > radius_km:
+                        ok = False
+            else:
+                score += location_text_boost[i]
+        combined[i] = score if ok else -np.inf
+    return combined, distances
+
+# Not parallel: gunicorn threads call this concurrently and Numba's default
+# threading layer does not support concurrent parallel launches.
+_rank_kernel_jit = njit(cache=True)(_rank_kernel) if njit is not None else None
+
+def score_candidates(index: SiteIndex, base_scores: np.ndarray, boosts: np.ndarray, keep: np.ndarray,
+                     use_geo: bool, ulat: float, ulon: float,
+                     radius_km: Optional[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply geo boosts and the radius filter; returns (combined scores, distances_km)"""
+    radius = np.nan if radius_km is None else float(radius_km)
+    if _rank_kernel_jit is not None:
+        return _rank_kernel_jit(base_scores, boosts, keep, index.lats_rad, index.lons_rad, index.cos_lats,
+                                index.has_coords, index.location_text_boost, use_geo, ulat, ulon, radius)
+
+    distances = np.full(len(base_scores), np.nan)
+    boosts = boosts.copy()
+    if use_geo:
+        if not (np.isnan(ulat) or np.isnan(ulon)):
+            distances = haversine_km(ulat, ulon, index.lats_rad, index.lons_rad, index.cos_lats)
+        # radius filter (NaN distances never compare greater, so they are kept)
+        keep = keep & ~(distances > radius)
+        # distance decay: within 5km strong, 5-20 moderate
+        boosts += np.where(distances <= 5, 0.15, np.where(distances <= 20, 0.08, 0.0))
+        boosts += np.where(index.has_coords, 0.0, index.location_text_boost)
+    return np.where(keep, base_scores + boosts, -np.inf), distances
+
+def open_now_rows(index: SiteIndex, now: datetime) -> np.ndarray:
+    """Rows whose opening hours include now (minute resolution, both ends inclusive)"""
+    rows, starts, ends = index.open_intervals[WEEKDAYS[now.weekday()]]
+    now_min = now.hour * 60 + now.minute
+    return np.unique(rows[(starts <= now_min) & (now_min <= ends)])
 
 def rank_candidates(query: str, site_data: Dict, user_id: str, history: List[str], 
                    user_lat: Optional[float] = None, user_lon: Optional[float] = None,
                    debug: bool = False, ab_variant: Optional[str] = None) -> Tuple[List[str], List[Dict], Optional[Dict]]:
-    # Cache key: query + basic site_data fingerprint
-    cache_key = json.dumps({
-        "q": query,
-        "uid": user_id,
-        "lat": user_lat,
-        "lon": user_lon,
-        "intent": detect_intent(query),
-        "radius": site_data.get("settings", {}).get("radius_km")
-    }, sort_keys=True)
-    now_ts = datetime.utcnow().timestamp()
-    cached = SUGGESTION_CACHE.get(cache_key)
-    if cached and (now_ts - cached.get("ts", 0) <= SUGGESTION_CACHE_TTL_SECONDS):
-        return cached["suggestions"], cached["cards"], cached.get("debug") if debug else (cached["suggestions"], cached["cards"], None)
-
-    candidates = build_candidates(site_data)
-    if not candidates:
+    intent = detect_intent(query)
+    radius_km = None
+    try:
+        radius_km = float(site_data.get("settings", {}).get("radius_km"))
+    except Exception:
+        radius_km = None
+    # Cache key: query + basic site_data fingerprint (a plain tuple hashes faster than a JSON string).
+    # Built from parsed values so arbitrary request JSON stays hashable and "30" / 30.0 share an entry;
+    # keyed on the manual data version too, so blacklist/synonym edits are not masked by cached suggestions
+    _refresh_manual_data_if_stale()
+    cache_key = (query, user_id, _to_float(user_lat, None), _to_float(user_lon, None), intent, radius_km,
+                 _manual_data_version)
+    with _cache_lock:
+        cached = SUGGESTION_CACHE.get(cache_key)
+        recent_queries = list(USER_HISTORY_CACHE.get(user_id, ()))
+    if cached:
+        return cached["suggestions"], cached["cards"], (cached.get("debug") if debug else None)
+
+    index = get_site_index(site_data)
+    if index is None:
         # Cold-start: return top manual categories/professions
         cold = []
         for item in get_manual_data("category") + get_manual_data("profession"):
@@ -562,7 +1302,7 @@ def rank_candidates(query: str, site_data: Dict, user_id: str, history: List[str
         cold = cold[:5] or ["Popular services near you"]
         return cold, [], {"reason": "cold_start"} if debug else (cold, [], None)
 
-    ranked = hybrid_rank(query, candidates)
+    base_scores = hybrid_rank(query, index)
     locs = detect_locations(query)
     city = locs[0] if locs else None
 
@@ -570,118 +1310,100 @@ def rank_candidates(query: str, site_data: Dict, user_id: str, history: List[str
     user_prefs = get_user_preferences(user_id)
     user_negs = get_user_negative_preferences(user_id)
 
-    # Apply boosts
-    scores = []
-    radius_km = None
-    try:
-        radius_km = float(site_data.get("settings", {}).get("radius_km"))
-    except Exception:
-        radius_km = None
+    # Apply boosts over the whole candidate array
+    n = len(index.candidates)
+    texts_lower = index.texts_lower
     blacklist = set(get_blacklist())
-    whitelist = set(get_whitelist())
-    intent = detect_intent(query)
-    for cand, sc in ranked:
-        boost = 0.0
-        text = cand["text"]
+    keep = np.ones(n, dtype=bool)
+    boosts = index.static_boost.copy()
+
+    # Quality controls
+    if blacklist:
+        keep &= ~np.fromiter((any(b in t for b in blacklist) for t in texts_lower), dtype=bool, count=n)
+
+    # History boost (each matching history entry adds BOOST_HISTORY)
+    history_counts = Counter(h.lower() for h in history + recent_queries)
+    for h, count in history_counts.items():
+        boosts += (BOOST_HISTORY * count) * np.fromiter((h in t for t in texts_lower), dtype=bool, count=n)
+
+    # Location boost
+    if city:
+        city_lower = city.lower()
+        boosts += BOOST_LOCATION_MATCH * np.fromiter(
+            (bool(loc) and city_lower in loc for loc in index.locations_lower), dtype=bool, count=n)
+
+    # Learning-based boost
+    for text_lower, value in user_prefs.items():
+        i = index.positions.get(text_lower)
+        if i is not None:
+            boosts[i] += BOOST_LEARNED_PATTERN * (value / 10.0)
+    for text_lower, value in user_negs.items():
+        i = index.positions.get(text_lower)
+        if i is not None:
+            boosts[i] -= BOOST_LEARNED_PATTERN * (value / 5.0)
+
+    # Pattern-based boost from learning data
+    successful = LEARNING_DATA["successful_suggestions"]
+    if len(successful) < n:
+        learned_rows = [index.positions[t] for t in list(successful) if t in index.positions]
+    else:
+        learned_rows = [i for i, t in enumerate(texts_lower) if t in successful]
+    boosts[learned_rows] += BOOST_LEARNED_PATTERN * 0.5
 
-        # Quality controls
-        if blacklist and any(b in text.lower() for b in blacklist):
-            continue
-        if whitelist and not any(w in text.lower() for w in whitelist):
-            pass  # optional light boost if needed
+    # Availability
+    boosts[open_now_rows(index, datetime.now())] += 0.05
 
-        # History boost
-        for h in history + USER_HISTORY_CACHE[user_id]:
-            if h.lower() in text.lower():
-                boost += BOOST_HISTORY
+    # Enhanced location boost with coordinates, radius filter and final score in one pass
+    combined, distances = score_candidates(index, base_scores, boosts, keep, bool(user_lat and user_lon),
+                                           _to_float(user_lat), _to_float(user_lon), radius_km)
+    keep = combined != -np.inf
 
-        # Rating boost
-        if cand.get("rating", 0) >= 4.5:
-            boost += BOOST_HIGH_RATING
+    # Top-K selection: O(N) partition, then sort only the K winners (ties by index)
+    k = min(TOP_K, int(keep.sum()))
+    top = np.argpartition(-combined, k - 1)[:k] if 0 < k < n else np.flatnonzero(keep)
+    top = top[np.lexsort((top, -combined[top]))]
 
-        # Location boost
-        if city and cand.get("location") and city.lower() in cand["location"].lower():
-            boost += BOOST_LOCATION_MATCH
-        
-        # Enhanced location boost with coordinates
-        distance_km = None
-        if user_lat and user_lon and (cand.get("latitude") is not None) and (cand.get("longitude") is not None):
-            try:
-                distance_km = calculate_distance(float(user_lat), float(user_lon), float(cand["latitude"]), float(cand["longitude"]))
-                # distance decay: within 5km strong, 5-20 moderate
-                if distance_km <= 5:
-                    boost += 0.15
-                elif distance_km <= 20:
-                    boost += 0.08
-                else:
-                    boost += 0.0
-                # radius filter
-                if radius_km is not None and distance_km > radius_km:
-                    continue
-            except Exception:
-                pass
-        elif user_lat and user_lon and cand.get("location"):
-            boost += get_location_boost(user_lat, user_lon, cand["location"])
-
-        # Learning-based boost
-        if text.lower() in user_prefs:
-            boost += BOOST_LEARNED_PATTERN * (user_prefs[text.lower()] / 10.0)
-        if text.lower() in user_negs:
-            boost -= BOOST_LEARNED_PATTERN * (user_negs[text.lower()] / 5.0)
-
-        # Pattern-based boost from learning data
-        if text.lower() in LEARNING_DATA["successful_suggestions"]:
-            boost += BOOST_LEARNED_PATTERN * 0.5
-
-        # Business rules
-        if cand.get("featured"):
-            boost += 0.1
-        if cand.get("plan_level") in ("premium", "gold", "platinum"):
-            boost += 0.08
-        boost += float(cand.get("priority_score", 0)) * 0.05
-
-        # Availability/promotions
-        if _is_open_now(cand.get("hours")):
-            boost += 0.05
-        if cand.get("promo_badge"):
-            boost += 0.03
-
-        scores.append((cand, sc + boost, distance_km))
-
-    scores.sort(key=lambda x: -x[1])
+    # Rewrite top candidates into user-friendly suggestions, deduping as we go and
+    # formatting only until 5 unique suggestions exist
+    seen, final = set(), []
+    for i in top[:5]:
+        for s in rewrite_with_intent(index.candidates[i]["text"], city, intent):
+            if s.lower() not in seen:
+                final.append(s)
+                seen.add(s.lower())
+            if len(final) >= 5:
+                break
+        if len(final) >= 5:
+            break
 
-    # Rewrite top candidates into user-friendly suggestions
-    suggestions = []
+    # Member cards (only for member/tag-derived with profile_url or id)
     cards = []
-    for cand, _, dist in scores[:5]:
-        # Suggestion text with intent
-        suggestions.extend(rewrite_with_intent(cand["text"], city, intent))
-        # Member card (only for member/tag-derived with profile_url or id)
-        if cand.get("type") in ("member", "tag", "review") and (cand.get("profile_url") or cand.get("id")):
+    for i in top[:5]:
+        cand = index.candidates[i]
+        if cand.get("type") not in ("member", "tag", "review"):
+            continue
+        mem = index.member(cand)
+        if mem.get("profile_url") or mem.get("id"):
+            dist = distances[i]
             cards.append({
                 "title": cand["text"],
-                "member_id": cand.get("id"),
-                "profile_url": cand.get("profile_url"),
-                "thumbnail_url": cand.get("thumbnail_url"),
-                "rating": cand.get("rating"),
-                "location": cand.get("location"),
-                "distance_km": round(dist, 2) if dist is not None else None,
-                "promo_badge": cand.get("promo_badge"),
-                "featured": cand.get("featured", False),
+                "member_id": mem.get("id"),
+                "profile_url": mem.get("profile_url"),
+                "thumbnail_url": mem.get("thumbnail_url"),
+                "rating": mem.get("rating"),
+                "location": mem.get("location"),
+                "distance_km": None if np.isnan(dist) else round(float(dist), 2),
+                "promo_badge": mem.get("promo_badge"),
+                "featured": mem.get("featured", False),
             })
 
-    # Dedup & limit to 5
-    seen, final = set(), []
-    for s in suggestions:
-        if s.lower() not in seen:
-            final.append(s)
-            seen.add(s.lower())
-        if len(final) >= 5:
-            break
-
     # Cache query into user history
-    if query not in USER_HISTORY_CACHE[user_id]:
-        USER_HISTORY_CACHE[user_id].append(query)
+    with _cache_lock:
+        recent = USER_HISTORY_CACHE.get(user_id)
+        if recent is None:
+            recent = USER_HISTORY_CACHE[user_id] = deque(maxlen=USER_HISTORY_PER_USER)
+        if query not in recent:
+            recent.append(query)
 
     debug_info = None
     if debug:
@@ -690,17 +1412,21 @@ def rank_candidates(query: str, site_data: Dict, user_id: str, history: List[str
             "city": city,
             "top_candidates": [
                 {
-                    "text": c[0]["text"],
-                    "type": c[0].get("type"),
-                    "score": round(c[1], 4),
-                    "distance_km": c[2]
-                } for c in scores[:10]
+                    "text": index.candidates[i]["text"],
+                    "type": index.candidates[i].get("type"),
+                    "score": round(float(combined[i]), 4),
+                    "distance_km": None if np.isnan(distances[i]) else float(distances[i])
+                } for i in top
             ]
         }
 
     # Update popular queries and set cache
-    POPULAR_QUERIES[query.lower()] += 1
-    SUGGESTION_CACHE[cache_key] = {"ts": now_ts, "suggestions": final, "cards": cards, "debug": debug_info}
+    with _cache_lock:
+        POPULAR_QUERIES[query.lower()] = POPULAR_QUERIES.get(query.lower(), 0) + 1
+        try:
+            SUGGESTION_CACHE[cache_key] = {"suggestions": final, "cards": cards, "debug": debug_info}
+        except ValueError:
+            pass  # single entry larger than SUGGESTION_CACHE_MAX_BYTES
 
     return final, cards, debug_info
 
@@ -709,11 +1435,6 @@ def rank_candidates(query: str, site_data: Dict, user_id: str, history: List[str
 # ---------------------------
 @app.route("/suggest", methods=["POST"])
 def suggest():
-    auth = require_api_key()
-    if auth is False:
-        return jsonify({"error": "Unauthorized"}), 401
-    if auth == "rate_limited":
-        return jsonify({"error": "Too Many Requests"}), 429
     data = request.get_json(force=True)
     query = data.get("current_query", "").strip()
     user_id = data.get("user_id", "anon")
@@ -731,24 +1452,8 @@ def suggest():
     try:
         suggestions, cards, debug_info = rank_candidates(query, site_data, user_id, history, user_lat, user_lon, debug_flag, ab_variant)
         
-        # Save the search interaction for learning
-        save_search_interaction(user_id, query, suggestions, location=location)
-        # Record A/B variant in latest search_history row
-        try:
-            if ab_variant:
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE search_history
-                    SET ab_variant = ?
-                    WHERE user_id = ? AND query = ? AND timestamp = (
-                        SELECT MAX(timestamp) FROM search_history WHERE user_id = ? AND query = ?
-                    )
-                ''', (ab_variant, user_id, query, user_id, query))
-                conn.commit()
-                conn.close()
-        except Exception:
-            pass
+        # Save the search interaction (with its A/B variant) for learning
+        save_search_interaction(user_id, query, suggestions, location=location, ab_variant=ab_variant)
         
         resp = {
             "original_query": query,
@@ -770,11 +1475,6 @@ def home():
 @app.route("/feedback", methods=["POST"])
 
 def feedback():
-    auth = require_api_key()
-    if auth is False:
-        return jsonify({"error": "Unauthorized"}), 401
-    if auth == "rate_limited":
-        return jsonify({"error": "Too Many Requests"}), 429
     """Endpoint to receive feedback on suggestions for learning"""
     data = request.get_json(force=True)
     user_id = data.get("user_id", "anon")
@@ -787,19 +1487,8 @@ def feedback():
         return jsonify({"error": "query and selected_suggestion are required"}), 400
 
     try:
-        # Update the search history with feedback
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE search_history 
-            SET selected_suggestion = ?, success_rating = ?
-            WHERE user_id = ? AND query = ? AND timestamp > datetime('now', '-1 hour')
-            ORDER BY timestamp DESC LIMIT 1
-        ''', (selected_suggestion, success_rating, user_id, query))
-        
-        conn.commit()
-        conn.close()
+        # Update the search history with feedback; queued behind the search insert it targets
+        enqueue_write(_FEEDBACK_SQL, (selected_suggestion, success_rating, user_id, query))
         
         # Update learning patterns
         LEARNING_DATA["successful_suggestions"][selected_suggestion.lower()] += success_rating
@@ -811,11 +1500,6 @@ def feedback():
 
 @app.route("/data", methods=["POST"])
 def add_data():
-    auth = require_api_key()
-    if auth is False:
-        return jsonify({"error": "Unauthorized"}), 401
-    if auth == "rate_limited":
-        return jsonify({"error": "Too Many Requests"}), 429
     """Endpoint to manually add data to the system"""
     data = request.get_json(force=True)
     data_type = data.get("type", "").strip()
@@ -825,9 +1509,8 @@ def add_data():
     if not data_type or not content:
         return jsonify({"error": "type and content are required"}), 400
 
-    valid_types = ["category", "member", "profession", "location", "synonym", "blacklist", "whitelist"]
-    if data_type not in valid_types:
-        return jsonify({"error": f"type must be one of: {valid_types}"}), 400
+    if data_type not in MANUAL_DATA_TYPES:
+        return jsonify({"error": f"type must be one of: {list(MANUAL_DATA_TYPES)}"}), 400
 
     try:
         add_manual_data(data_type, content, added_by)
@@ -838,41 +1521,55 @@ def add_data():
 
 @app.route("/batch_import", methods=["POST"])
 def batch_import():
-    auth = require_api_key()
-    if auth is False:
-        return jsonify({"error": "Unauthorized"}), 401
-    if auth == "rate_limited":
-        return jsonify({"error": "Too Many Requests"}), 429
     data = request.get_json(force=True)
     items = data.get("items", [])
     added_by = data.get("added_by", "batch")
     if not isinstance(items, list) or not items:
         return jsonify({"error": "items (array) is required"}), 400
-    valid_types = {"category", "member", "profession", "location"}
     success, failed = 0, 0
+    by_type: Dict[str, List[Dict]] = defaultdict(list)
     for it in items:
         try:
-            t = (it.get("type") or "").strip()
+            t = it.get("type")
+            t = t.strip() if t else ""
             c = it.get("content", {})
-            if t not in valid_types or not c:
-                failed += 1
-                continue
-            add_manual_data(t, c, added_by)
-            success += 1
         except Exception:
             failed += 1
+            continue
+        if t not in BATCH_IMPORT_TYPES or not c:
+            failed += 1
+            continue
+        by_type[t].append(c)
+    # One write transaction for the whole batch, one executemany (and savepoint) per type
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for t, contents in by_type.items():
+            try:
+                add_manual_data_many(t, contents, added_by)
+                success += len(contents)
+            except Exception:
+                logging.exception(f"Batch import of {len(contents)} {t} items failed")
+                failed += len(contents)
+    if success:
+        bump_manual_data_version()
+        analyze_database()
     return jsonify({"status": "ok", "imported": success, "failed": failed})
 
 @app.route("/data", methods=["GET"])
 def get_data():
-    auth = require_api_key()
-    if auth is False:
-        return jsonify({"error": "Unauthorized"}), 401
-    if auth == "rate_limited":
-        return jsonify({"error": "Too Many Requests"}), 429
     """Endpoint to retrieve manual data"""
     data_type = request.args.get("type")
-    
+
+    if request.args.get("stream") == "1":
+        # NDJSON straight from the cursor; stored content is already JSON, so it is spliced in as-is
+        def generate():
+            for row_type, content in iter_manual_data(data_type):
+                if data_type:
+                    yield content + "\n"
+                else:
+                    yield f'{{"type":{orjson.dumps(row_type).decode("utf-8")},"content":{content}}}\n'
+        return Response(generate(), mimetype="application/x-ndjson")
+
     try:
         data = get_manual_data(data_type)
         return jsonify({"data": data, "count": len(data)})
@@ -880,116 +1577,104 @@ def get_data():
         logging.exception("Error retrieving data")
         return jsonify({"error": str(e)}), 500
 
+# Statistics, top queries, top suggestions and event counts in one round trip;
+# the list sections come back as JSON arrays. {range} is a plain column filter so
+# every aggregate reads its own index (idx_sh_ts, idx_sh_query, idx_sh_sel, idx_ev_ts_type).
+_ANALYTICS_SQL_TEMPLATE = '''
+    SELECT
+        stats.total_searches, stats.unique_users, stats.average_rating,
+        (SELECT json_group_array(json_object('query', query, 'frequency', frequency)) FROM (
+            SELECT query, COUNT(*) AS frequency FROM search_history
+            WHERE {range}
+            GROUP BY query ORDER BY frequency DESC LIMIT 10
+        )) AS top_queries,
+        (SELECT json_group_array(json_object('suggestion', selected_suggestion, 'frequency', frequency)) FROM (
+            SELECT selected_suggestion, COUNT(*) AS frequency FROM search_history
+            WHERE selected_suggestion IS NOT NULL AND {range}
+            GROUP BY selected_suggestion ORDER BY frequency DESC LIMIT 10
+        )) AS top_suggestions,
+        (SELECT json_group_array(json_object('event_type', event_type, 'count', count)) FROM (
+            SELECT event_type, COUNT(*) AS count FROM events
+            WHERE {range}
+            GROUP BY event_type
+        )) AS events
+    FROM (
+        SELECT COUNT(*) AS total_searches, COUNT(DISTINCT user_id) AS unique_users,
+               AVG(success_rating) AS average_rating
+        FROM search_history WHERE {range}
+    ) AS stats
+'''
+_ANALYTICS_SQL = _ANALYTICS_SQL_TEMPLATE.format(range="1")
+_ANALYTICS_RANGE_SQL = _ANALYTICS_SQL_TEMPLATE.format(range="timestamp BETWEEN :start AND :end")
+
+def learning_patterns_json() -> orjson.Fragment:
+    """LEARNING_DATA["query_patterns"] as pre-serialized JSON, re-encoded only after it changes"""
+    global _patterns_snapshot
+    version = _patterns_version
+    if _patterns_snapshot[0] != version:
+        _patterns_snapshot = (version, orjson.dumps(LEARNING_DATA["query_patterns"], option=orjson.OPT_SORT_KEYS))
+    return orjson.Fragment(_patterns_snapshot[1])
+
+def _build_analytics_responses(start: Optional[str], end: Optional[str]) -> Dict[str, Tuple[bytes, str]]:
+    """Run the analytics query once and serialize both the JSON and CSV bodies, for ANALYTICS_CACHE"""
+    # Date filter applies only when both ends are given
+    with get_conn() as conn:
+        if start and end:
+            row = conn.execute(_ANALYTICS_RANGE_SQL, {"start": start, "end": end}).fetchone()
+        else:
+            row = conn.execute(_ANALYTICS_SQL).fetchone()
+    top_queries = orjson.loads(row["top_queries"])
+
+    payload = {
+        "statistics": {
+            "total_searches": row["total_searches"],
+            "unique_users": row["unique_users"],
+            "average_rating": round(row["average_rating"] or 0, 2)
+        },
+        "top_queries": top_queries,
+        "top_suggestions": orjson.loads(row["top_suggestions"]),
+        "events": orjson.loads(row["events"]),
+        "learning_patterns": learning_patterns_json()
+    }
+    # simple CSV export of top queries; csv.writer quotes commas/quotes/newlines in queries
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(["query", "frequency"])
+    writer.writerows((q["query"], q["frequency"]) for q in top_queries)
+    response = jsonify(payload)
+    return {
+        "json": (response.get_data(), response.mimetype),
+        "csv": (buf.getvalue().encode("utf-8"), "text/csv"),
+    }
+
+def bump_analytics_version():
+    global _analytics_version
+    with _cache_lock:
+        _analytics_version += 1
+
 @app.route("/analytics", methods=["GET"])
 def analytics():
-    auth = require_api_key()
-    if auth is False:
-        return jsonify({"error": "Unauthorized"}), 401
-    if auth == "rate_limited":
-        return jsonify({"error": "Too Many Requests"}), 429
     """Endpoint to get learning analytics"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
         start = request.args.get("start")
         end = request.args.get("end")
         out_format = request.args.get("format", "json")
 
-        # Get search statistics
-        if start and end:
-            cursor.execute('''
-                SELECT COUNT(*), COUNT(DISTINCT user_id), AVG(success_rating)
-                FROM search_history
-                WHERE timestamp BETWEEN ? AND ?
-            ''', (start, end))
-        else:
-            cursor.execute('''
-                SELECT COUNT(*), COUNT(DISTINCT user_id), AVG(success_rating)
-                FROM search_history
-            ''')
-        stats = cursor.fetchone()
-        
-        # Get top queries
-        if start and end:
-            cursor.execute('''
-                SELECT query, COUNT(*) as frequency
-                FROM search_history
-                WHERE timestamp BETWEEN ? AND ?
-                GROUP BY query
-                ORDER BY frequency DESC
-                LIMIT 10
-            ''', (start, end))
-        else:
-            cursor.execute('''
-                SELECT query, COUNT(*) as frequency
-                FROM search_history
-                GROUP BY query
-                ORDER BY frequency DESC
-                LIMIT 10
-            ''')
-        top_queries = cursor.fetchall()
-        
-        # Get top suggestions
-        if start and end:
-            cursor.execute('''
-                SELECT selected_suggestion, COUNT(*) as frequency
-                FROM search_history
-                WHERE selected_suggestion IS NOT NULL AND timestamp BETWEEN ? AND ?
-                GROUP BY selected_suggestion
-                ORDER BY frequency DESC
-                LIMIT 10
-            ''', (start, end))
-        else:
-            cursor.execute('''
-                SELECT selected_suggestion, COUNT(*) as frequency
-                FROM search_history
-                WHERE selected_suggestion IS NOT NULL
-                GROUP BY selected_suggestion
-                ORDER BY frequency DESC
-                LIMIT 10
-            ''')
-        top_suggestions = cursor.fetchall()
-
-        # Events count by type
-        if start and end:
-            cursor.execute('''
-                SELECT event_type, COUNT(*) FROM events WHERE timestamp BETWEEN ? AND ? GROUP BY event_type
-            ''', (start, end))
-        else:
-            cursor.execute('''
-                SELECT event_type, COUNT(*) FROM events GROUP BY event_type
-            ''')
-        events_counts = cursor.fetchall()
-        
-        conn.close()
-        
-        payload = {
-            "statistics": {
-                "total_searches": stats[0],
-                "unique_users": stats[1],
-                "average_rating": round(stats[2] or 0, 2)
-            },
-            "top_queries": [{"query": q[0], "frequency": q[1]} for q in top_queries],
-            "top_suggestions": [{"suggestion": s[0], "frequency": s[1]} for s in top_suggestions],
-            "events": [{"event_type": e[0], "count": e[1]} for e in events_counts],
-            "learning_patterns": dict(LEARNING_DATA["query_patterns"])
-        }
-        if out_format == "csv":
-            # simple CSV export of top queries
-            lines = ["query,frequency"] + [f"{q[0]},{q[1]}" for q in top_queries]
-            return Response("\n".join(lines), mimetype='text/csv')
-        return jsonify(payload)
+        cache_key = (start, end, _analytics_version)
+        with _cache_lock:
+            cached = ANALYTICS_CACHE.get(cache_key)
+        if cached is None:
+            cached = _build_analytics_responses(start, end)
+            with _cache_lock:
+                ANALYTICS_CACHE[cache_key] = cached
+        body, mimetype = cached["csv" if out_format == "csv" else "json"]
+        return Response(body, mimetype=mimetype)
     except Exception as e:
         logging.exception("Error getting analytics")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/event", methods=["POST"])
 def track_event():
-    auth = require_api_key()
-    if auth is False:
-        return jsonify({"error": "Unauthorized"}), 401
-    if auth == "rate_limited":
-        return jsonify({"error": "Too Many Requests"}), 429
     data = request.get_json(force=True)
     user_id = data.get("user_id", "anon")
     event_type = data.get("event_type")
@@ -997,35 +1682,70 @@ def track_event():
     if not event_type:
         return jsonify({"error": "event_type is required"}), 400
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO events (user_id, event_type, payload) VALUES (?, ?, ?)
-        ''', (user_id, event_type, json.dumps(payload)))
-        conn.commit()
-        conn.close()
-        return jsonify({"status": "ok"})
+        enqueue_write(_INSERT_EVENT_SQL, (user_id, event_type, orjson.dumps(payload).decode("utf-8")))
+        return jsonify({"status": "accepted"}), 202
     except Exception as e:
         logging.exception("Error tracking event")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/", methods=["GET"])
 def health():
-    return jsonify({"status": "ok", "service": "bd-suggest-extended", "model": MODEL_NAME})
-    
-public_url = ngrok.connect(5000)
-print(" * ngrok tunnel \"{}\" -> \"http://127.0.0.1:5000\"".format(public_url))
+    return jsonify({"status": "ok", "service": "bd-suggest-extended", "model": MODEL_NAME, "backend": EMBEDDING_BACKEND})
 
-if __name__ == "__main__":
-    # Initialize database on startup
-    init_database()
-    
-    # Download required NLTK data
+# ---------------------------
+# Startup
+# ---------------------------
+WARMUP_ON_IMPORT = os.environ.get("WARMUP_ON_IMPORT", "1") == "1"
+
+def warmup():
+    """Pay model/NER/WordNet load and Numba compile costs at startup instead of on the first request"""
+    _encode_length_sorted(["warmup"])
+    nlp("warmup")
+    # Run the JIT kernels once on a one-member index so they compile with the request-path signatures
+    candidates, members = build_candidates({"members": [
+        {"id": 0, "name": "warmup", "tags": "warmup", "location": "warmup", "latitude": 0.0, "longitude": 0.0}
+    ]})
+    index = build_site_index(candidates, members)
+    score_candidates(index, hybrid_rank("warmup", index), index.static_boost.copy(),
+                     np.ones(len(candidates), dtype=bool), True, 0.0, 0.0, 50.0)
     try:
-        nltk.data.find('corpora/wordnet')
+        wn.synsets("test")
     except LookupError:
-        nltk.download('wordnet')
-    
+        logging.warning("WordNet corpus not found (python -m nltk.downloader wordnet); expand_synonyms is unavailable")
+    logging.info("Warm-up complete")
+
+# Runs on import so `gunicorn app:app` workers find the schema in place
+init_database()
+
+# `python app.py` hands off to gunicorn, whose workers import (and warm up) the module themselves
+if WARMUP_ON_IMPORT and __name__ != "__main__":
+    warmup()
+
+GUNICORN_WORKERS = int(os.environ.get("GUNICORN_WORKERS", "2"))
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+def run_gunicorn(port: int):
+    """Replace this process with gunicorn serving app:app on gthread workers"""
+    os.execv(sys.executable, [
+        sys.executable, "-m", "gunicorn",
+        "--chdir", os.path.dirname(os.path.abspath(__file__)),
+        "-w", str(GUNICORN_WORKERS), "-k", "gthread", "--threads", str(GUNICORN_THREADS),
+        "--worker-connections", "128", "-b", f"0.0.0.0:{port}", "app:app",
+    ])
+
+if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    #app.run(host="127.0.0.1", port=port, debug=False)
-    app.run(port=5000)
+    if os.environ.get("ENABLE_NGROK") == "1":
+        # Public tunnel for local demos only; never opened by imported/worker processes
+        from pyngrok import ngrok
+        public_url = ngrok.connect(port)
+        print(" * ngrok tunnel \"{}\" -> \"http://127.0.0.1:{}\"".format(public_url, port))
+    dev = "--dev" in sys.argv
+    if not dev and importlib.util.find_spec("gunicorn") is not None:
+        run_gunicorn(port)  # does not return
+    # Development server: `--dev`, or gunicorn unavailable (it is POSIX-only)
+    if not dev:
+        logging.warning("gunicorn is not available; starting the Flask development server")
+    if WARMUP_ON_IMPORT:
+        warmup()
+    app.run(port=port, threaded=True)
@@ -14,13 +14,23 @@ import string
 import time
 from statistics import mean, median
 import requests
+from requests.adapters import HTTPAdapter
 
 
 def random_user_id(prefix: str = "user") -> str:
     return f"{prefix}_" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
 
 
-def make_request(base_url: str, api_key: str, idx: int) -> dict:
+def make_session(concurrency: int) -> requests.Session:
+    """One keep-alive connection pool shared by all workers, sized so no worker waits for a connection"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def make_request(session: requests.Session, base_url: str, api_key: str, idx: int) -> dict:
     user_id = random_user_id("u")
     # Alternate queries to exercise synonyms, intents, and geo
     queries = [
@@ -51,7 +61,7 @@ def make_request(base_url: str, api_key: str, idx: int) -> dict:
     headers = {"X-API-Key": api_key, "Content-Type": "application/json"}
     start = time.perf_counter()
     try:
-        r = requests.post(f"{base_url.rstrip('/')}/suggest", json=payload, headers=headers, timeout=15)
+        r = session.post(f"{base_url.rstrip('/')}/suggest", json=payload, headers=headers, timeout=15)
         elapsed = (time.perf_counter() - start) * 1000.0
         return {
             "status": r.status_code,
@@ -66,9 +76,10 @@ def make_request(base_url: str, api_key: str, idx: int) -> dict:
 
 def run_load_test(base_url: str, api_key: str, total_requests: int, concurrency: int):
     results = []
+    session = make_session(concurrency)
     t0 = time.time()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
-        futures = [executor.submit(make_request, base_url, api_key, i) for i in range(total_requests)]
+    with session, concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(make_request, session, base_url, api_key, i) for i in range(total_requests)]
         for fut in concurrent.futures.as_completed(futures):
             results.append(fut.result())
     t1 = time.time()